@@ -1,42 +1,147 @@
 import os
-from pyrogram import Client, filters, enums
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import asyncio
+
+try:
+    import uvloop
+    # Must run before pyrogram is imported, pyrogram.sync grabs the event loop at import
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+# Create the one loop everything shares, recent uvloop and Python no longer make one implicitly
+asyncio.set_event_loop(asyncio.new_event_loop())
+
+from pyrogram import Client, filters, enums, idle, raw
+from pyrogram.errors import FloodWait
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
-from flask import Flask, redirect
-from threading import Thread
+from collections import defaultdict
+from datetime import datetime, timezone
 from motor.motor_asyncio import AsyncIOMotorClient
-import asyncio
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+import heapq
+import itertools
+import random
+import time
 
 API_ID = os.environ.get("API_ID")
 API_HASH = os.environ.get("API_HASH")
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 DATABASE_URL = os.environ.get("DATABASE_URL")
-BOT_USERNAME = os.environ.get("BOT_USERNAME", "cleanerfmrobot")
+# "asyncio" serves the redirect on PORT, "none" skips the web server
+HEALTH_SERVER = os.environ.get("HEALTH_SERVER", "asyncio")
+if HEALTH_SERVER not in ("asyncio", "none"):
+    raise SystemExit(f"HEALTH_SERVER must be 'asyncio' or 'none', not {HEALTH_SERVER!r}")
+
+USAGE_TEXT = "**Please provide the delete time in seconds. Usage:** `/set_time <time_in_seconds>`"
+INVALID_TIME_TEXT = "Delete time must be an integer."
+# one week, also keeps expiry timestamps and stored values in range
+MAX_DELETE_TIME = 604800
+TIME_RANGE_TEXT = f"Delete time can be at most {MAX_DELETE_TIME} seconds."
+
+# logging: handlers only enqueue, the listener thread does the writing
+log_queue = queue.SimpleQueue()
+queue_handler = QueueHandler(log_queue)
+# QueueHandler formats the message before enqueueing, the stream handler adds the prefix
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(handlers=[queue_handler])
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+listener = QueueListener(log_queue, stream_handler)
+logger = logging.getLogger("deletebot")
 
 #database
-client = AsyncIOMotorClient(DATABASE_URL)
+client = AsyncIOMotorClient(
+    DATABASE_URL,
+    maxPoolSize=50,
+    minPoolSize=10,
+    maxIdleTimeMS=60000,
+    waitQueueTimeoutMS=2000,
+    serverSelectionTimeoutMS=3000,
+    compressors="zstd,snappy,zlib",
+    retryWrites=True
+)
 db = client['databas']
 groups = db['group_id']
+pending = db['pending']
+
+# delete time per group, loaded at startup and written behind on /set_time
+GROUP_SETTINGS = {}
+# chats whose delete time still has to be saved, flushed in bulk
+DIRTY = set()
+SETTINGS_FLUSH_INTERVAL = 5
+
+# admin cache: (chat_id, user_id) -> (is admin, checked at)
+ADMIN_CACHE = {}
+ADMIN_TTL = 300
+ADMIN_STATUSES = (enums.ChatMemberStatus.ADMINISTRATOR, enums.ChatMemberStatus.OWNER)
 
+# scheduled deletions: heap of (expires at, chat_id, message_id, received at),
+# mirrored in the pending collection so they survive restarts
+SCHEDULE = []
+wakeup = asyncio.Event()
+BATCH_SIZE = 100
+# per-chat token bucket for delete calls: chat_id -> (tokens, last refill)
+BUCKETS = {}
+DELETE_RATE = 1
+DELETE_BURST = 3
+# resolved input peers, so batch deletes skip the lookup
+PEERS = {}
+# strong references to fire-and-forget writes, so they are not collected mid-flight
+BACKGROUND = set()
+# how long past its expiry the TTL index keeps a job; restarts replay every job still stored,
+# so an outage longer than this loses deletions
+PENDING_GRACE = MAX_DELETE_TIME
 
 bot = Client(
     "deletebot",
     api_id=API_ID,
     api_hash=API_HASH,
     bot_token=BOT_TOKEN,
-    workers=300,
-    sleep_threshold=10
+    # handlers are short coroutines, a few workers per core keep up
+    workers=min(32, (os.cpu_count() or 1) * 4),
+    sleep_threshold=10,
+    # No session file to write on every update, but each start has to import the bot
+    # authorization again, which Telegram rate-limits (crash loops will FloodWait at login)
+    in_memory=True
 )
 
+async def is_admin(chat_id, user_id):
+    key = (chat_id, user_id)
+    cached = ADMIN_CACHE.get(key)
+    if cached and time.monotonic() - cached[1] < ADMIN_TTL:
+        return cached[0]
+    member = await bot.get_chat_member(chat_id, user_id)
+    admin = member.status in ADMIN_STATUSES
+    ADMIN_CACHE[key] = (admin, time.monotonic())
+    return admin
+
+@bot.on_chat_member_updated()
+async def member_updated(_, update):
+    # The member's rights may have changed, check them again on next use
+    member = update.new_chat_member or update.old_chat_member
+    if member and member.user:
+        ADMIN_CACHE.pop((update.chat.id, member.user.id), None)
+
+START_TEXT = "**Hello {},\nI am a AutoDelete Bot, I can delete your groups messages automatically after a certain period of time.\nUsage:** `/set_time <time_in_seconds>`"
+# built once the bot knows its own username
+START_MARKUP = None
+
+def build_start_markup(username):
+    global START_MARKUP
+    START_MARKUP = InlineKeyboardMarkup([[
+            InlineKeyboardButton("➕ Add me in your Group", url=f"http://t.me/{username}?startgroup=none&admin=delete_messages"),
+            ],[
+            InlineKeyboardButton("📌 Updates channel", url=f"https://t.me/filmy_men"),
+        ]])
+
 @bot.on_message(filters.command("start") & filters.private)
 async def start(_, message):
-    button = [[
-        InlineKeyboardButton("➕ Add me in your Group", url=f"http://t.me/{BOT_USERNAME}?startgroup=none&admin=delete_messages"),
-        ],[
-        InlineKeyboardButton("📌 Updates channel", url=f"https://t.me/filmy_men"),
-    ]]
     await message.reply_text(
-        f"**Hello {message.from_user.first_name},\nI am a AutoDelete Bot, I can delete your groups messages automatically after a certain period of time.\nUsage:** `/set_time <time_in_seconds>`",
-        reply_markup=InlineKeyboardMarkup(button),
+        START_TEXT.format(message.from_user.first_name),
+        reply_markup=START_MARKUP,
         parse_mode=enums.ParseMode.MARKDOWN
     )
     
@@ -47,60 +152,287 @@ async def set_delete_time(_, message):
         await message.reply("This command can only be used in groups.")
         return
     # Extract group_id and delete_time from the message
-    if len(message.text.split()) == 1:
-        await message.reply_text("**Please provide the delete time in seconds. Usage:** `/set_time <time_in_seconds>`")
+    parts = message.command
+    if len(parts) == 1:
+        await message.reply_text(USAGE_TEXT)
+        return
+    delete_time = parts[1]
+    # isdecimal, not isdigit: "²" is a digit but int() rejects it
+    if not delete_time.isdecimal():
+        await message.reply_text(INVALID_TIME_TEXT)
         return
-    delete_time = message.text.split()[1]
-    if not delete_time.isdigit():
-        await message.reply_text("Delete time must be an integer.")
+    delete_time = int(delete_time)
+    if delete_time > MAX_DELETE_TIME:
+        await message.reply_text(TIME_RANGE_TEXT)
         return
     chat_id = message.chat.id
     user_id = message.from_user.id
     # Check if the user is the group owner or an admin
-    administrators = []
-    async for m in bot.get_chat_members(chat_id, filter=enums.ChatMembersFilter.ADMINISTRATORS):
-        administrators.append(m.user.id)
-    if user_id not in administrators:
+    if not await is_admin(chat_id, user_id):
         await message.reply("Only group admins can enable or disable auto approve.")
         return
-    # Save to the database
-    await groups.update_one(
-        {"group_id": chat_id},
-        {"$set": {"delete_time": delete_time}},
-        upsert=True
-    )
+    GROUP_SETTINGS[chat_id] = delete_time
+    retime(chat_id, delete_time)
+    # Move the stored expiries too, so a restart and the TTL index follow the new delete time
+    spawn(pending.update_many(
+        {"chat_id": chat_id, "received_at": {"$exists": True}},
+        [{"$set": {"expire_at": {"$add": ["$received_at", delete_time * 1000]}}}]
+    ))
+    # Saved to the database by the settings flusher
+    DIRTY.add(chat_id)
     try:
         await message.reply_text(f"**Set delete time to {delete_time} seconds for this group.**")
     except Exception as e:
         await message.reply_text(f"Erorr: {e}")
          
-@bot.on_message(filters.group & filters.text)
+@bot.on_message(
+    filters.group
+    & filters.incoming
+    & (filters.text | filters.photo | filters.video | filters.document)
+    & ~filters.service
+    & ~filters.me
+    & ~filters.bot
+)
 async def delete_message(_, message):
     chat_id = message.chat.id
     # Check if the group has a delete time set
-    group = await groups.find_one({"group_id": chat_id})
-    if not group:
+    delete_time = GROUP_SETTINGS.get(chat_id)
+    if delete_time is None:
+        return
+    received_at = time.time()
+    expire_at = received_at + delete_time
+    entry = (expire_at, chat_id, message.id, received_at)
+    heapq.heappush(SCHEDULE, entry)
+    if SCHEDULE[0] is entry:
+        # Only a new earliest expiry changes how long the reaper should sleep
+        wakeup.set()
+    spawn(pending.insert_one({
+        "chat_id": chat_id,
+        "message_id": message.id,
+        "expire_at": datetime.utcfromtimestamp(expire_at),
+        "received_at": datetime.utcfromtimestamp(received_at)
+    }))
+
+def retime(chat_id, delete_time):
+    # Already scheduled messages follow the new delete time, shorter or longer
+    for i, (_, entry_chat, message_id, received_at) in enumerate(SCHEDULE):
+        if entry_chat == chat_id:
+            SCHEDULE[i] = (received_at + delete_time, chat_id, message_id, received_at)
+    heapq.heapify(SCHEDULE)
+    wakeup.set()
+
+def spawn(coro):
+    task = asyncio.ensure_future(coro)
+    BACKGROUND.add(task)
+    task.add_done_callback(background_done)
+
+def background_done(task):
+    BACKGROUND.discard(task)
+    # Nothing awaits these writes, so a failure would otherwise go unnoticed
+    if not task.cancelled() and task.exception():
+        logger.warning("Background database write failed: %r", task.exception())
+
+async def reaper():
+    while True:
+        delay = SCHEDULE[0][0] - time.time() if SCHEDULE else None
+        if delay is None or delay > 0:
+            # Sleep until the earliest expiry, or until a new entry is pushed
+            try:
+                await asyncio.wait_for(wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+            continue
+        now = time.time()
+        due = defaultdict(list)
+        while SCHEDULE and SCHEDULE[0][0] <= now:
+            _, chat_id, message_id, received_at = heapq.heappop(SCHEDULE)
+            due[chat_id].append((message_id, received_at))
+        for chat_id, entries in due.items():
+            for i in range(0, len(entries), BATCH_SIZE):
+                batch = entries[i:i + BATCH_SIZE]
+                ids = [message_id for message_id, _ in batch]
+                # Over the chat's rate, hold the batch back instead of provoking a FloodWait
+                wait = take_token(chat_id)
+                if not wait:
+                    wait = await delete_batch(chat_id, ids)
+                    if wait:
+                        drain_bucket(chat_id, wait)
+                    else:
+                        await forget_pending(chat_id, ids)
+                if wait:
+                    reschedule(chat_id, batch, wait)
+
+async def forget_pending(chat_id, ids):
+    try:
+        await pending.delete_many({"chat_id": chat_id, "message_id": {"$in": ids}})
+    except Exception as e:
+        # Left-over jobs only cost a failed delete after a restart, and the TTL index clears them
+        logger.warning("Could not clear pending deletes in group %s: %r", chat_id, e)
+
+def reschedule(chat_id, entries, delay):
+    retry_at = time.time() + delay
+    for message_id, received_at in entries:
+        heapq.heappush(SCHEDULE, (retry_at, chat_id, message_id, received_at))
+
+def take_token(chat_id):
+    """Return 0 if a delete call may go out now, else the seconds until it may."""
+    now = time.monotonic()
+    tokens, last = BUCKETS.get(chat_id, (DELETE_BURST, now))
+    tokens = min(DELETE_BURST, tokens + (now - last) * DELETE_RATE)
+    if tokens < 1:
+        BUCKETS[chat_id] = (tokens, now)
+        return (1 - tokens) / DELETE_RATE
+    BUCKETS[chat_id] = (tokens - 1, now)
+    return 0
+
+def drain_bucket(chat_id, wait):
+    # Telegram asked for a pause, no calls for this chat until it is over
+    BUCKETS[chat_id] = (1 - wait * DELETE_RATE, time.monotonic())
+
+async def delete_batch(chat_id, ids):
+    """Return the seconds Telegram wants the batch held back, 0 when it is done with."""
+    try:
+        await delete_ids(chat_id, ids)
+    except FloodWait as e:
+        # Never sleep here, the reaper serves every chat
+        return e.value
+    except Exception as e:
+        logger.warning("Delete failed in group %s: %r", chat_id, e)
+    return 0
+
+async def delete_ids(chat_id, ids):
+    peer = PEERS.get(chat_id)
+    if peer is None:
+        peer = PEERS[chat_id] = await bot.resolve_peer(chat_id)
+    if isinstance(peer, raw.types.InputPeerChannel):
+        await bot.invoke(raw.functions.channels.DeleteMessages(channel=peer, id=ids))
+    else:
+        await bot.invoke(raw.functions.messages.DeleteMessages(id=ids, revoke=True))
+
+async def flush_settings():
+    if not DIRTY:
         return
-    delete_time = int(group["delete_time"])
+    chats = list(DIRTY)
+    ops = [
+        UpdateOne({"group_id": chat_id}, {"$set": {"delete_time": GROUP_SETTINGS[chat_id]}}, upsert=True)
+        for chat_id in chats
+    ]
+    DIRTY.clear()
     try:
-        # Delete the message
-        await asyncio.sleep(delete_time)
-        await message.delete()
+        await groups.bulk_write(ops, ordered=False)
+    except asyncio.CancelledError:
+        DIRTY.update(chats)
+        raise
     except Exception as e:
-        print(f"An error occurred: {e}/nGroup ID: {chat_id}")    
+        # Keep them dirty, the next flush tries again
+        DIRTY.update(chats)
+        logger.warning("Could not save group settings: %r", e)
 
+async def settings_flusher():
+    while True:
+        await asyncio.sleep(SETTINGS_FLUSH_INTERVAL)
+        try:
+            await flush_settings()
+        except Exception as e:
+            logger.warning("Settings flush failed: %r", e)
 
-# Flask configuration
-app = Flask(__name__)
 
-@app.route('/')
-def index():
-    return redirect(f"https://telegram.me/gojo_satoruji", code=302)
+# Web server: every request gets the same redirect, served on the bot's event loop
+REDIRECT_RESPONSE = (
+    b"HTTP/1.1 302 Found\r\n"
+    b"Location: https://telegram.me/gojo_satoruji\r\n"
+    b"Content-Length: 0\r\n"
+    b"Connection: close\r\n\r\n"
+)
+
+async def index(reader, writer):
+    try:
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+        writer.write(REDIRECT_RESPONSE)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def run():
+    return await asyncio.start_server(index, "0.0.0.0", int(os.environ.get('PORT', 8080)))
+
+async def load_group_settings():
+    # Older versions upserted without an index, so duplicates may exist
+    try:
+        await groups.create_index("group_id", unique=True)
+    except OperationFailure as e:
+        logger.warning("Could not create the unique group_id index, remove duplicate groups: %r", e)
+    # Old documents may carry group_id as a string, which never matches a lookup by chat id
+    try:
+        await groups.update_many(
+            {"group_id": {"$type": "string"}},
+            [{"$set": {"group_id": {"$toLong": "$group_id"}}}]
+        )
+    except OperationFailure as e:
+        logger.warning("Could not convert string group ids: %r", e)
+    async for group in groups.find({}, {"group_id": 1, "delete_time": 1, "_id": 0}).batch_size(1000):
+        # Values stored before /set_time was validated would crash startup or the scheduler
+        delete_time = str(group.get("delete_time"))
+        if not delete_time.isdecimal() or int(delete_time) > MAX_DELETE_TIME:
+            logger.warning("Ignoring invalid delete time %r of group %s", group.get("delete_time"), group["group_id"])
+            continue
+        # setdefault: a /set_time that ran during loading is newer than this read
+        GROUP_SETTINGS.setdefault(int(group["group_id"]), int(delete_time))
+
+async def load_pending():
+    try:
+        await pending.create_index("expire_at", expireAfterSeconds=PENDING_GRACE)
+    except OperationFailure:
+        # The index exists with an older grace, change it in place
+        await db.command("collMod", "pending", index={"keyPattern": {"expire_at": 1}, "expireAfterSeconds": PENDING_GRACE})
+    await pending.create_index([("chat_id", 1), ("message_id", 1)])
+    # Replay deletions scheduled before the last restart
+    async for job in pending.find({}, {"_id": 0}).batch_size(1000):
+        expire_at = job["expire_at"].replace(tzinfo=timezone.utc).timestamp()
+        # Jobs from before received_at was recorded fall back to their expiry
+        received_at = job.get("received_at", job["expire_at"]).replace(tzinfo=timezone.utc).timestamp()
+        SCHEDULE.append((expire_at, int(job["chat_id"]), job["message_id"], received_at))
+    heapq.heapify(SCHEDULE)
+
+async def start_bot():
+    for attempt in itertools.count():
+        try:
+            await bot.start()
+            build_start_markup(bot.me.username)
+            return
+        except FloodWait as e:
+            await asyncio.sleep(e.value)
+        except (OSError, asyncio.TimeoutError) as e:
+            # Network trouble, back off exponentially with jitter
+            delay = min(60, 2 ** attempt) + random.random()
+            logger.warning("Could not start the bot (%r), retrying in %.1fs", e, delay)
+            await asyncio.sleep(delay)
 
-def run():
-    app.run(host="0.0.0.0", port=int(os.environ.get('PORT', 8080)))
+async def main():
+    # Listen first, so the health check passes during login backoff and FloodWait waits
+    server = await run() if HEALTH_SERVER != "none" else None
+    # Warm the pool, and fail fast if the database is unreachable
+    await client.admin.command("ping")
+    # Settings are still loading while the bot logs in; unknown chats are just skipped meanwhile
+    await asyncio.gather(load_group_settings(), load_pending(), start_bot())
+    reaper_task = asyncio.create_task(reaper())
+    flusher_task = asyncio.create_task(settings_flusher())
+    await idle()
+    reaper_task.cancel()
+    await asyncio.gather(*BACKGROUND, return_exceptions=True)
+    flusher_task.cancel()
+    # Let a cancelled in-flight flush put its chats back before the last one
+    await asyncio.gather(flusher_task, return_exceptions=True)
+    await flush_settings()
+    if server:
+        server.close()
+        await server.wait_closed()
+    await bot.stop()
 
 if __name__ == "__main__":
-    t = Thread(target=run)
-    t.start()
-    bot.run()    
+    listener.start()
+    bot.run(main())
+    listener.stop()    